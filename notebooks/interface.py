@@ -2,22 +2,25 @@ import data
 from journey_planner import JourneyPlanner, id_from_name
 from journey_finder import JourneyFinder
 from journey_visualization import JourneyVisualization
+from station_registry import StationRegistry
 import pandas as pd
+import itertools
 
 import panel as pn
 pn.extension()
 
 connections, footpaths, stations = data.load_data()
-jp = JourneyPlanner(stations)
+registry = StationRegistry(stations, itertools.chain(connections['start_id'], connections['stop_id']))
+jp = JourneyPlanner(registry)
 journey_planner = jp.interface
-journey_finder = JourneyFinder(connections, footpaths)
+journey_finder = JourneyFinder(connections, footpaths, registry)
 
 
 def journeys():
-    departure_station_id = id_from_name(stations, jp.departure_station_widget.value)
-    arrival_station_id = id_from_name(stations, jp.arrival_station_widget.value)
+    departure_station_id = id_from_name(registry, jp.departure_station_widget.value)
+    arrival_station_id = id_from_name(registry, jp.arrival_station_widget.value)
     arrival_time = int(pd.to_datetime(jp.arrival_time_widget.value).timestamp())
     min_probability = jp.min_probability_widget.value
     journey_finder.find(departure_station_id, arrival_station_id, arrival_time, min_probability=min_probability)
     best_journeys = journey_finder.best_journeys()
-    return JourneyVisualization(best_journeys, stations, arrival_time).interface
\ No newline at end of file
+    return JourneyVisualization(best_journeys, registry, arrival_time).interface
\ No newline at end of file
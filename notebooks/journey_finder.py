@@ -1,8 +1,12 @@
 import numpy as np
 import pandas as pd
 import collections
+import copy
+import itertools
 import math
 
+from query_log import make_query
+
 
 EMPTY_DF = pd.DataFrame([], columns=['start_id', 'start_time', 'trip_id', 'transport_type', 'line_text', 'stop_time', 'stop_id', 'delay_probability', 'delay_parameter', 'probability', 'transfers', 'path'])
 
@@ -13,54 +17,169 @@ class JourneyFinder:
 
     This class is only used to store values and give easy access to the 
     journey finder functions.
+
+    If `recorder` is given it is called with a `query_log.Query` for every
+    call to `find`.
     """
     
-    def __init__(self, connections, footpaths):
-        self.connections = [Connection(*row) for row in connections.values]
-        self.footpaths = footpaths
-        self._unique_stations = np.unique([(c.start_id, c.stop_id) for c in self.connections])
-        self._stations = None
-        self._departure_station_id = None
+    def __init__(self, connections, footpaths, registry, recorder=None):
+        self.registry = registry
+        self.recorder = recorder
+        self.connections = [Connection(*row) for row in connections.assign(
+            start_id=registry.indices(connections['start_id'].values),
+            stop_id=registry.indices(connections['stop_id'].values)
+        ).values]
+        self.footpaths = footpaths_by_index(footpaths, registry)
+        self._stop_times = np.array([c.stop_time for c in self.connections])
+        self._arena = ProfileArena(len(registry))
+        self._departure_station_index = None
+
+    def copy(self):
+        """Returns a finder that shares connections and footpaths with this finder
+
+        The copy has its own profile storage and no recorder, so copies can
+        run queries concurrently.
+        """
+        finder = copy.copy(self)
+        finder.recorder = None
+        finder._arena = ProfileArena(len(self.registry))
+        finder._departure_station_index = None
+        return finder
     
     def find(self, departure_station_id, arrival_station_id, arrival_time, 
              min_probability=0.9, max_probability=0.999999, transfer_time=120):
         """Finds journeys from `departure_station_id` to `arrival_station_id`
         
-        Use `self.best_journeys()` to get the best journeys.
+        Station ids are external ids, they are mapped to dense indices with
+        `self.registry`. Use `self.best_journeys()` to get the best journeys.
         """
-        self._departure_station_id = departure_station_id
-        self._stations = find(self.connections, self.footpaths, self._unique_stations, 
-                              departure_station_id, arrival_station_id, arrival_time, 
-                             min_probability, max_probability, transfer_time)
+        departure_station_index = self.registry.index(departure_station_id)
+        arrival_station_index = self.registry.index(arrival_station_id)
+        if self.recorder is not None:
+            # queries with unknown stations raise above and are not recorded
+            self.recorder(make_query(departure_station_id, arrival_station_id, arrival_time, min_probability, transfer_time))
+        self._departure_station_index = departure_station_index
+        find(self.connections, self._stop_times, self.footpaths, self._arena, 
+             departure_station_index, arrival_station_index, arrival_time, 
+             min_probability, max_probability, transfer_time)
         
-    def best_journeys(self):
-        """Returns best journeys"""
-        return best_journeys(self._stations, self._departure_station_id)
+    def best_journeys(self, max_journeys=8, diverse=False, max_shared_trips=0, max_shared_rides=0, max_transfers=None):
+        """Returns best journeys
+
+        Use `diverse=True` to get alternative journeys instead of journeys that
+        improve the arrival probability, see `best_journeys`.
+        """
+        return best_journeys(self._arena, self._departure_station_index, self.registry.ids, 
+                             max_journeys=max_journeys, diverse=diverse, max_shared_trips=max_shared_trips, 
+                             max_shared_rides=max_shared_rides, max_transfers=max_transfers)
+
+
+def footpaths_by_index(footpaths, registry):
+    """Converts the footpaths dictionary into a list indexed by dense station index
+
+    Entry `i` holds the `(start_index, walk_time)` tuples of all footpaths
+    arriving at station `i`.
+    """
+    indexed = [[] for _ in range(len(registry))]
+    for stop_id, paths in footpaths.items():
+        indexed[registry.index(stop_id)] = [(registry.index(start_id), walk_time) for start_id, walk_time in paths]
+    return indexed
+
+
+class ProfileArena:
+    """Reusable per-station profile storage for `find`
+
+    Station state and profile entries live in flat preallocated lists that
+    are reused between queries. `reset` only clears the stations touched by
+    the previous query.
+
+    Profile entries are stored column-wise: entry `e` is described by
+    `next_entry[e]`, `probability[e]`, `start_time[e]`, ... Footpath legs
+    have `foot[e]` set and no connection.
+    """
+
+    _entry_fields = ('next_entry', 'probability', 'start_time', 'stop_time', 'stop_id', 'trip_id', 'foot', 'connection')
+
+    def __init__(self, n_stations, capacity=1024):
+        # per-station state
+        self.best_probability = [0.0] * n_stations
+        self.min_departure_time = [-1] * n_stations
+        self.profiles = [[] for _ in range(n_stations)]
+        self.touched = []
+
+        # profile entries
+        self.size = 0
+        self.next_entry = [-1] * capacity
+        self.probability = [0.0] * capacity
+        self.start_time = [0] * capacity
+        self.stop_time = [0] * capacity
+        self.stop_id = [-1] * capacity
+        self.trip_id = [None] * capacity
+        self.foot = [False] * capacity
+        self.connection = [None] * capacity
+
+    def reset(self):
+        """Clears the profiles of all stations touched since the last reset"""
+        for station_id in self.touched:
+            self.best_probability[station_id] = 0.0
+            self.min_departure_time[station_id] = -1
+            self.profiles[station_id].clear()
+        self.touched.clear()
+        self.size = 0
+
+    def add(self, station_id, next_entry, probability, start_time, stop_time, stop_id, trip_id, foot, connection):
+        """Appends an entry to the profile of `station_id` and returns its entry id"""
+        entry = self.size
+        if entry == len(self.next_entry):
+            # double the capacity, lists are extended in place so that
+            # references held by `find` stay valid
+            for field in self._entry_fields:
+                values = getattr(self, field)
+                values.extend(values)
+        self.next_entry[entry] = next_entry
+        self.probability[entry] = probability
+        self.start_time[entry] = start_time
+        self.stop_time[entry] = stop_time
+        self.stop_id[entry] = stop_id
+        self.trip_id[entry] = trip_id
+        self.foot[entry] = foot
+        self.connection[entry] = connection
+        profile = self.profiles[station_id]
+        if not profile:
+            self.touched.append(station_id)
+        profile.append(entry)
+        self.size = entry + 1
+        return entry
 
 # Description of the journey finding algorithm            
 # =========================================        
 # The find function maintains one datastructure and a couple of constraints
 # 
 # Data Structure
-# ==============
-# The data structure is a dictionary with station_ids as keys and a tuple as values.
-# The value tuple is structured as follows: 
-#   (highest_probability, latest_departure_time, [connection tuples])
-#   - highest_probability: 
+# ==============
+# The data structure is a `ProfileArena` which holds flat lists indexed by
+# dense station index (see station_registry.py):
+#   - best_probability: 
 #       The arrival probability of the best connection leaving from the station
-#   - latest_departure_time: 
+#   - min_departure_time: 
 #       The departure time of the latest connection leaving the station that 
 #       reaches the arrival station with very high probability (p >= max_probability)
-#   - connection tuple: 
-#       Holds information on a connection leaving the station. values: 
-#           (index, arrival_probability, connection)
-#           - index: 
-#               Holds the index of the follow up connection in the 
-#               connections list of the stop_station for the this connection
-#           - arrival_probability: 
-#               Probability to arrive on time at arrival station if this 
-#               connection is taken
-#           - connection: a connection object
+#   - profiles: 
+#       The ids of the profile entries leaving the station, in the order they were added
+#
+# Every profile entry holds information on a connection or footpath leaving
+# a station. Its values are stored in flat lists indexed by entry id:
+#   - next_entry: 
+#       Entry id of the follow up connection at the stop_station
+#   - probability: 
+#       Probability to arrive on time at arrival station if this 
+#       connection is taken
+#   - start_time, stop_time, stop_id: departure/arrival of the leg
+#   - trip_id: 
+#       Trip of the connection, None for footpaths and the arrival entry
+#       (no transfer time is required to take them)
+#   - foot: True if the entry is a footpath leg
+#   - connection: the connection object, None for footpath legs
 #
 # Constraints
 # ===========
@@ -114,129 +233,131 @@ class JourneyFinder:
 # journey departs.
 
 
-def find(connections, footpaths, unique_stations, departure_station_id, arrival_station_id, arrival_time, 
+def find(connections, stop_times, footpaths, arena, departure_station_id, arrival_station_id, arrival_time, 
              min_probability, max_probability, transfer_time):
-    """Finds best journeys using the given connections and footpaths"""
+    """Finds best journeys using the given connections and footpaths
+
+    All station ids are dense station indices. The profiles are written to
+    `arena`, which is reset first.
+    """
     
-    # create intial stations dictionary
-    # probability of arrival is set to 0 and time of departure set to -1
-    # the list of departing connections is empty
-    stations = {station_id: (0.0, -1, []) for station_id in unique_stations}
+    # probability of arrival is 0 and time of departure -1 for all
+    # stations and there are no departing connections
+    arena.reset()
+    best_probability = arena.best_probability
+    min_departure_time = arena.min_departure_time
+    profiles = arena.profiles
+    entry_probability = arena.probability
+    entry_start_time = arena.start_time
+    entry_trip_id = arena.trip_id
     
-    # add dummy connection to the arrival station
-    stations[arrival_station_id] = (1.0, arrival_time, [(None, 1.0, Connection(arrival_station_id, arrival_time, '', None, None, None, None, None, None))])
+    # add arrival entry to the arrival station
+    arrival_entry = arena.add(arrival_station_id, -1, 1.0, arrival_time, arrival_time, -1, None, False, None)
+    best_probability[arrival_station_id] = 1.0
+    min_departure_time[arrival_station_id] = arrival_time
     
     # departure_min_time is unconstrained until a journey
     # from departure_station to arrival_station is found
     departure_min_time = -1
     
-    # increases by 1 for every footpath connection that is added
-    # is used to generate a unique trip_id for every footpath
-    foot_counter = 0
-    
     # explore stations that can be reached by foot from arrival_station
-    # from each such station we add a connection to the arrival_station
-    for start_id, walktime in footpaths.get(arrival_station_id, []):
-        _, _, start_connections = stations[start_id]
+    # from each such station we add a footpath to the arrival_station
+    for start_id, walktime in footpaths[arrival_station_id]:
         departure_time = arrival_time - walktime
-        new_connection = (0, 1.0, Connection(start_id, departure_time, f'foot:{foot_counter}', 'foot', '', arrival_time, arrival_station_id, 0, 0))
-        start_connections.append(new_connection)
+        arena.add(start_id, arrival_entry, 1.0, departure_time, arrival_time, arrival_station_id, None, True, None)
         if start_id == departure_station_id:
             departure_min_time = departure_time
-        stations[start_id] = (1.0, departure_time, start_connections)
-        foot_counter += 1
+        best_probability[start_id] = 1.0
+        min_departure_time[start_id] = departure_time
 
-    # find index of the first connection in the connections list
-    # that arrives before/at the arrival_time (all later connections
-    # are ignored)
-    start_index = np.argmax(np.array([c.stop_time for c in connections]) <= arrival_time)
+    # find index of the first connection in the connections list
+    # that arrives before/at the arrival_time (all later connections
+    # are ignored), stop_times are sorted in decreasing order
+    start_index = len(stop_times) - np.searchsorted(stop_times[::-1], arrival_time, side='right')
 
-    for c in connections[start_index:]:
+    for c in itertools.islice(connections, start_index, None):
         if c.stop_time < departure_min_time:
             # no more connections left that could improve optimal journey
             break
 
-        stop_p, _, stop_connections = stations[c.stop_id]
-
         # check if there is a connection leaving the stop_station that can reach arrival_station in time
-        if stop_p >= min_probability:
-            start_p, start_min_time, start_connections = stations[c.start_id]
+        if best_probability[c.stop_id] >= min_probability:
+            start_min_time = min_departure_time[c.start_id]
 
-            # check if connection can improve the latest departure time of a 100% succeeding journey leaving start_station
+            # check if connection can improve the latest departure time of a 100% succeeding journey leaving start_station
             if c.start_time >= start_min_time:
 
-                # calculate probabilities to catch connections at stop_station
-                probabilities = [(0, -1.0)] * len(stop_connections)
-                for i, (_, p, stop) in enumerate(stop_connections):
-                    if stop.start_time >= c.stop_time:                            
-                        if c.trip_id == stop.trip_id:
-                            probabilities[i] = (i, p)
-                        elif (len(stop.trip_id) == 0) or (stop.transport_type == 'foot'):
-                            # len(stop.trip_id) == 0 means that stop is the fake connection at the arrival station!
-                            probabilities[i] = (i, p*(1-c.delay_probability*math.exp(-c.delay_parameter * (stop.start_time - c.stop_time))))
-                        elif stop.start_time >= c.stop_time + transfer_time:
-                            probabilities[i] = (i, p*(1-c.delay_probability*math.exp(-c.delay_parameter * (stop.start_time - c.stop_time - transfer_time))))
-                if probabilities:
-                    # select follow up connection with highest probability
-                    index, p = max(probabilities, key=lambda x: x[1])
-
-                    # stop if probability is too low
-                    if p >= min_probability:
-                        if start_connections:
-                            # take last connection added to start_station
-                            start = start_connections[-1]                        
-
-                        # check if the current connection is not strictly worse than the last connection added to start_station
-                        if not start_connections or not ((start[1] > p) and (start[2].start_time > c.start_time)):
-                            start_connections.append((index, p, c))
-
-
-                            # check if connection should be considered to arrive for sure
-                            if p >= max_probability:
-                                start_min_time = c.start_time
-                                if c.start_id == departure_station_id:
-                                    # set global constraint if a connection departing from departure_station
-                                    # is found that arrives for sure
-                                    departure_min_time = start_min_time
-
-                            # update entry of start_station
-                            max_p = max(p, start_p)
-                            stations[c.start_id] = (max_p, start_min_time, start_connections)
-
-                            # new footpath connections should point to the current connection
-                            # that was just added to the connections list of start_station
-                            index = len(start_connections) - 1
-
-                            # explore footpaths
-                            for previous_id, walk_time in footpaths.get(c.start_id, []):
-                                previous_departure_time = c.start_time - walk_time - transfer_time
-                                previous_p, previous_min_time, previous_connections = stations[previous_id]
-
-                                # check if we can find a better connection leaving the start_station of the footpath
-                                if previous_departure_time >= previous_min_time:
-                                    if previous_connections:
-                                        # take last connection added to start_station of footpath
-                                        previous = previous_connections[-1]
-
-                                    # check if taking footpath and then current connection is not strictly worse than
-                                    # the last connection added to the start_station of the footpath
-                                    if not previous_connections or not ((previous[1] > p) and (previous[2].start_time > previous_departure_time)):
-                                        # add new connection to start_station of footpath
-                                        previous_connections.append((index, p, Connection(previous_id, previous_departure_time, f'foot:{foot_counter}', 'foot', '', previous_departure_time + walk_time, c.start_id, 0, 0)))
-                                        foot_counter += 1
-                                        
-                                        # check if footpath followed by connection should be considered to arrive for sure
-                                        if p >= max_probability:
-                                            previous_min_time = previous_departure_time
-                                            if previous_id == departure_station_id:
-                                                # update global constraint if footpaths leaves departure_station
-                                                # and arrives for sure
-                                                departure_min_time = max(departure_min_time, previous_departure_time)
-
-                                        # update entry of footpaths start_station
-                                        max_p = max(p, previous_p)
-                                        stations[previous_id] = (max_p, previous_min_time, previous_connections)
-    return stations
+                # select follow up connection at stop_station with highest probability
+                index, p = -1, -1.0
+                for entry in profiles[c.stop_id]:
+                    stop_start_time = entry_start_time[entry]
+                    if stop_start_time >= c.stop_time:
+                        if c.trip_id == entry_trip_id[entry]:
+                            entry_p = entry_probability[entry]
+                        elif entry_trip_id[entry] is None:
+                            # footpath or arrival entry, no transfer time required
+                            entry_p = entry_probability[entry]*(1-c.delay_probability*math.exp(-c.delay_parameter * (stop_start_time - c.stop_time)))
+                        elif stop_start_time >= c.stop_time + transfer_time:
+                            entry_p = entry_probability[entry]*(1-c.delay_probability*math.exp(-c.delay_parameter * (stop_start_time - c.stop_time - transfer_time)))
+                        else:
+                            continue
+                        if entry_p > p:
+                            index, p = entry, entry_p
+
+                # stop if probability is too low
+                if p >= min_probability:
+                    start_profile = profiles[c.start_id]
+                    if start_profile:
+                        # take last entry added to start_station
+                        start = start_profile[-1]
+
+                    # check if the current connection is not strictly worse than the last connection added to start_station
+                    if not start_profile or not ((entry_probability[start] > p) and (entry_start_time[start] > c.start_time)):
+                        # new footpath entries point to this entry
+                        index = arena.add(c.start_id, index, p, c.start_time, c.stop_time, c.stop_id, c.trip_id, False, c)
+
+                        # check if connection should be considered to arrive for sure
+                        if p >= max_probability:
+                            start_min_time = c.start_time
+                            if c.start_id == departure_station_id:
+                                # set global constraint if a connection departing from departure_station
+                                # is found that arrives for sure
+                                departure_min_time = start_min_time
+
+                        # update entry of start_station
+                        best_probability[c.start_id] = max(p, best_probability[c.start_id])
+                        min_departure_time[c.start_id] = start_min_time
+
+                        # explore footpaths
+                        for previous_id, walk_time in footpaths[c.start_id]:
+                            previous_departure_time = c.start_time - walk_time - transfer_time
+                            previous_min_time = min_departure_time[previous_id]
+
+                            # check if we can find a better connection leaving the start_station of the footpath
+                            if previous_departure_time >= previous_min_time:
+                                previous_profile = profiles[previous_id]
+                                if previous_profile:
+                                    # take last entry added to start_station of footpath
+                                    previous = previous_profile[-1]
+
+                                # check if taking footpath and then current connection is not strictly worse than
+                                # the last connection added to the start_station of the footpath
+                                if not previous_profile or not ((entry_probability[previous] > p) and (entry_start_time[previous] > previous_departure_time)):
+                                    # add new footpath entry to start_station of footpath
+                                    arena.add(previous_id, index, p, previous_departure_time, previous_departure_time + walk_time, c.start_id, None, True, None)
+                                    
+                                    # check if footpath followed by connection should be considered to arrive for sure
+                                    if p >= max_probability:
+                                        previous_min_time = previous_departure_time
+                                        if previous_id == departure_station_id:
+                                            # update global constraint if footpaths leaves departure_station
+                                            # and arrives for sure
+                                            departure_min_time = max(departure_min_time, previous_departure_time)
+
+                                    # update entry of footpaths start_station
+                                    best_probability[previous_id] = max(p, best_probability[previous_id])
+                                    min_departure_time[previous_id] = previous_min_time
+    return arena
 
 
 def concatenate(solutions):
@@ -250,8 +371,11 @@ def concatenate(solutions):
     return None
 
 
-def to_df(journey):
-    """Converts a list of connections into a dataframe"""
+def to_df(journey, station_ids):
+    """Converts a list of connections into a dataframe
+
+    Dense station indices are mapped back to external ids with `station_ids`.
+    """
     values = []
     transfers = set()
     for p, c in journey:
@@ -259,12 +383,52 @@ def to_df(journey):
         values.append([*c, p, len(transfers), 0])
     df = pd.DataFrame(values, columns=['start_id', 'start_time', 'trip_id', 'transport_type', 'line_text', 'stop_time', 'stop_id', 'delay_probability', 'delay_parameter', 'probability', 'transfers', 'path'])
     df['transfers'] = len(transfers)
+    df['start_id'] = station_ids[df['start_id'].values.astype(int)]
+    df['stop_id'] = station_ids[df['stop_id'].values.astype(int)]
     return df
 
 
 
-def best_journeys(stations, departure_station_id, max_journeys=8, max_probability=0.999):
-    """Selects best journeys by traversing the stations dictionary created by `find`
+def journey_legs(arena, entry, start_id):
+    """Follows the profile entries starting at `entry` up to the arrival station
+
+    Returns a list of `(probability, connection)` tuples, footpath legs are
+    converted to connections.
+    """
+    legs = []
+    while arena.stop_id[entry] >= 0:
+        if arena.foot[entry]:
+            c = Connection(start_id, arena.start_time[entry], f'foot:{entry}', 'foot', '', arena.stop_time[entry], arena.stop_id[entry], 0, 0)
+        else:
+            c = arena.connection[entry]
+        legs.append((arena.probability[entry], c))
+        start_id = c.stop_id
+        entry = arena.next_entry[entry]
+    return legs
+
+
+def journey_rides(legs):
+    """Returns the trips and rides of a journey given as `(probability, connection)` legs
+
+    A ride is a `(line_text, start_id, stop_id)` tuple for consecutive legs on
+    the same trip. Footpaths are ignored.
+    """
+    rides = []
+    for _, c in legs:
+        if c.transport_type == 'foot':
+            continue
+        if rides and rides[-1][0] == c.trip_id:
+            rides[-1][3] = c.stop_id
+        else:
+            rides.append([c.trip_id, c.line_text, c.start_id, c.stop_id])
+    trips = {trip_id for trip_id, _, _, _ in rides}
+    rides = {(line_text, start_id, stop_id) for _, line_text, start_id, stop_id in rides}
+    return trips, rides
+
+
+def best_journeys(arena, departure_station_id, station_ids, max_journeys=8, max_probability=0.999, 
+                  diverse=False, max_shared_trips=0, max_shared_rides=0, max_transfers=None):
+    """Selects best journeys by traversing the profiles created by `find`
 
     The best journey is considered to be the journey that leaves as late as possible
     while still satisfying the `min_probability` constraint.
@@ -276,35 +440,52 @@ def best_journeys(stations, departure_station_id, max_journeys=8, max_probabilit
 
     The scan is stopped once a journey is found that arrives with `max_probability` or
     the list is exhausted.
+
+    If `diverse` is set, journeys do not have to improve the previous journey. Instead
+    a journey may share at most `max_shared_trips` trips and `max_shared_rides` rides
+    (same line between the same stations, see `journey_rides`) with every journey
+    selected before it. The scan is stopped once `max_journeys` journeys are found.
+
+    Journeys with more than `max_transfers` transfers are skipped in both modes. A
+    transfer is a change between two trips, footpaths are not counted (unlike the
+    `transfers` column, which counts footpaths as trips).
     """
 
     probability = 0.0
     journeys = []
+    selected_rides = []
     # sort departures in descending order of departure time
-    departures = sorted(stations[departure_station_id][-1], key=lambda x: (x[2].start_time, x[1]), reverse=True)
-    for i, (next_index, p, c) in enumerate(departures):
-        if probability >= max_probability:
+    departures = sorted(arena.profiles[departure_station_id], key=lambda e: (arena.start_time[e], arena.probability[e]), reverse=True)
+    for entry in departures:
+        if len(journeys) >= max_journeys:
             break
 
-        # check if journey has higher probability than previous best journey
-        if p > probability:
-            probability = p
-            journey = []
-            station_id = c.stop_id
-            journey.append((p, c))
-
-            # traverse the stations/connections by following the previous
-            # connections station_id and the index
-            while True:
-                next_index, p, c = stations[station_id][-1][next_index]
-                if c.stop_id is None:
-                    break
-                journey.append((p, c))
-                station_id = c.stop_id
-            journeys.append(to_df(journey))
+        p = arena.probability[entry]
+        if not diverse:
+            if probability >= max_probability:
+                break
+
+            # check if journey has higher probability than previous best journey
+            if p <= probability:
+                continue
+
+        legs = journey_legs(arena, entry, departure_station_id)
+        trips, rides = journey_rides(legs)
+        if max_transfers is not None and max(len(trips) - 1, 0) > max_transfers:
+            continue
+
+        if diverse:
+            # check if journey shares too many trips or rides with a selected journey
+            if any(len(trips & other_trips) > max_shared_trips or len(rides & other_rides) > max_shared_rides
+                   for other_trips, other_rides in selected_rides):
+                continue
+            selected_rides.append((trips, rides))
+
+        probability = p
+        journeys.append(to_df(legs, station_ids))
 
     # return dataframe of all journeys
     if journeys:
-        return concatenate(journeys[:max_journeys])
+        return concatenate(journeys)
     else:
-        return EMPTY_DF
\ No newline at end of file
+        return EMPTY_DF
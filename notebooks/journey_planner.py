@@ -9,33 +9,33 @@ import panel as pn
 from bokeh.models import HoverTool
 
 
-def id_from_name(stations, name):
-    return stations.loc[stations['station_name'] == name, 'station_id'].values[0]
+def id_from_name(registry, name):
+    return registry.ids[registry.index_from_name(name)]
 
 
-def closest_station(stations, lat, lon):
-    distances = np.sum((stations[['lat', 'lon']] - np.array([lat, lon])) ** 2, axis=1)
-    closest = np.argmin(distances)
-    return stations.iloc[closest]['station_id']
+def closest_station(registry, lat, lon):
+    return registry.closest(lat, lon)
 
 
-def set_to_closest_station(stations, widget, lat, lon):
-    station_id = closest_station(stations, lat, lon)
-    station_name = stations.loc[station_id, 'station_name']
+def set_to_closest_station(registry, widget, lat, lon):
+    station_name = registry.names[closest_station(registry, lat, lon)]
     if widget.value != station_name:
         widget.value = station_name
 
+
+def station_points(registry, indices):
+    return (registry.lat[indices], registry.lon[indices], registry.names[indices])
+
         
 class JourneyPlanner:
     
-    def __init__(self, stations):
+    def __init__(self, registry):
         self.default_departure_station = 'Zürich HB'
         self.default_arrival_station = 'Zürich, Auzelg'
-        self.default_departure_id = id_from_name(stations, self.default_departure_station)
-        self.default_arrival_id = id_from_name(stations, self.default_arrival_station)
-        zurich = stations.loc[self.default_departure_id]
-        self.stations = stations
-        self.station_names = list(self.stations['station_name'])
+        self.default_departure_index = registry.index_from_name(self.default_departure_station)
+        self.default_arrival_index = registry.index_from_name(self.default_arrival_station)
+        self.registry = registry
+        self.station_names = list(self.registry.names[~np.isnan(self.registry.lat)])
         
         self.default_arrival_time = datetime.datetime.fromisoformat('2019-05-06 12:30:00')
         self.default_min_success_probability = 0
@@ -66,17 +66,17 @@ class JourneyPlanner:
         )
         
         self.departure_tap_stream = hv.streams.SingleTap(
-            x=stations.loc[self.default_departure_id, 'lat'], 
-            y=stations.loc[self.default_departure_id, 'lon']
+            x=registry.lat[self.default_departure_index], 
+            y=registry.lon[self.default_departure_index]
         ).rename(x='departure_lat', y='departure_lon')
         
         self.arrival_tap_stream = hv.streams.DoubleTap(
-            x=stations.loc[self.default_arrival_id, 'lat'], 
-            y=stations.loc[self.default_arrival_id, 'lon']
+            x=registry.lat[self.default_arrival_index], 
+            y=registry.lon[self.default_arrival_index]
         ).rename(x='arrival_lat', y='arrival_lon')
         
-        self.departure_tap_stream.add_subscriber(lambda departure_lat, departure_lon: set_to_closest_station(self.stations, self.departure_station_widget, departure_lat, departure_lon))
-        self.arrival_tap_stream.add_subscriber(lambda arrival_lat, arrival_lon: set_to_closest_station(self.stations, self.arrival_station_widget, arrival_lat, arrival_lon))
+        self.departure_tap_stream.add_subscriber(lambda departure_lat, departure_lon: set_to_closest_station(self.registry, self.departure_station_widget, departure_lat, departure_lon))
+        self.arrival_tap_stream.add_subscriber(lambda arrival_lat, arrival_lon: set_to_closest_station(self.registry, self.arrival_station_widget, arrival_lat, arrival_lon))
         self.departure_station_widget.link(self.departure_tap_stream, callbacks={'value': self._update_stream})
         self.arrival_station_widget.link(self.arrival_tap_stream, callbacks={'value': self._update_stream})
         
@@ -109,11 +109,13 @@ class JourneyPlanner:
                 'responsive': True,
                 'active_tools': ['wheel_zoom']
             }
-            departure_station_id = closest_station(self.stations, departure_lat, departure_lon)
-            arrival_station_id = closest_station(self.stations, arrival_lat, arrival_lon)
-            unselected_stations = self.stations.loc[~self.stations['station_id'].isin([departure_station_id, arrival_station_id])]
-            departure_station = self.stations.loc[[departure_station_id]]
-            arrival_station = self.stations.loc[[arrival_station_id]]
+            departure_index = closest_station(self.registry, departure_lat, departure_lon)
+            arrival_index = closest_station(self.registry, arrival_lat, arrival_lon)
+            unselected_mask = ~np.isnan(self.registry.lat)
+            unselected_mask[[departure_index, arrival_index]] = False
+            unselected_stations = station_points(self.registry, unselected_mask)
+            departure_station = station_points(self.registry, [departure_index])
+            arrival_station = station_points(self.registry, [arrival_index])
             unselected = gv.Points(unselected_stations, ['lat', 'lon'], ['station_name']).opts(tools=[self.unselected_hover])
             departure = gv.Points(departure_station, ['lat', 'lon'], ['station_name']).opts(tools=[self.departure_hover], size=5, color='black')
             arrival = gv.Points(arrival_station, ['lat', 'lon'], ['station_name']).opts(tools=[self.arrival_hover], size=5, color='red')
@@ -123,9 +125,9 @@ class JourneyPlanner:
     
     def _update_stream(self, stream, event):
         station_name = event.new
-        station_id = id_from_name(self.stations, station_name) 
-        lat = self.stations.loc[station_id]['lat']
-        lon = self.stations.loc[station_id]['lon']
+        index = self.registry.index_from_name(station_name)
+        lat = self.registry.lat[index]
+        lon = self.registry.lon[index]
         if (stream.x != lat) or (stream.y != lon):
             stream.event(x=lat, y=lon)
     
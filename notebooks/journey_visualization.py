@@ -10,9 +10,9 @@ import itertools
 
 class JourneyVisualization:
 
-    def __init__(self, solutions, stations, stop_time):
-        self.solutions = format_solutions(solutions, stations)
-        self.stations = stations
+    def __init__(self, solutions, registry, stop_time):
+        self.solutions = format_solutions(solutions, registry)
+        self.registry = registry
         self.stop_time = stop_time
         
         self.line_aggregate = aggregate_lines(self.solutions)
@@ -121,9 +121,9 @@ def datetime_ticks(plot, element):
     plot.handles['xaxis'].formatter = DatetimeTickFormatter(minutes='%H:%M', hours='%H:%M')
 
 
-def format_solutions(solutions, stations):
+def format_solutions(solutions, registry):
     solutions = add_datetime(solutions)
-    solutions = add_station_info(solutions, stations)
+    solutions = add_station_info(solutions, registry)
     solutions = add_color(solutions)
     solutions = add_departure_arrival(solutions)
     solutions = add_yaxis(solutions)
@@ -137,14 +137,14 @@ def add_datetime(solutions):
     return solutions
 
 
-def add_station_info(solutions, stations):
-    joined = (
-        solutions
-        .join(stations.set_index('station_id'), 'start_id')
-        .join(stations.set_index('station_id'), 'stop_id', rsuffix='_stop')
-    )
-    joined.columns = [col.lower() for col in joined.columns]
-    return joined
+def add_station_info(solutions, registry):
+    for column, suffix in [('start_id', ''), ('stop_id', '_stop')]:
+        indices = registry.indices(solutions[column].values)
+        solutions['station_id' + suffix] = registry.ids[indices]
+        solutions['lat' + suffix] = registry.lat[indices]
+        solutions['lon' + suffix] = registry.lon[indices]
+        solutions['station_name' + suffix] = registry.names[indices]
+    return solutions
 
 
 def add_color(solutions, colormap='Category20'):
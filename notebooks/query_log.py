@@ -0,0 +1,47 @@
+import collections
+import json
+import threading
+
+from station_registry import normalize_id
+
+
+Query = collections.namedtuple('Query', 'departure arrival arrival_time min_probability transfer_time')
+
+
+def make_query(departure, arrival, arrival_time, min_probability, transfer_time):
+    """Creates a query with JSON serializable values"""
+    return Query(normalize_id(departure), normalize_id(arrival), int(arrival_time), float(min_probability), int(transfer_time))
+
+
+class QueryRecorder:
+    """Appends queries to a JSONL query log, one JSON object per line
+
+    Instances can be passed as `recorder` to `JourneyFinder`. The log is
+    opened once and line buffered, use `close()` or a `with` block to
+    close it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def __call__(self, query):
+        line = json.dumps(query._asdict()) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_queries(path):
+    """Reads all queries from a JSONL query log, empty lines are skipped"""
+    with open(path) as file:
+        return [make_query(**json.loads(line)) for line in file if line.strip()]
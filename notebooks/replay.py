@@ -0,0 +1,198 @@
+"""Replays a JSONL query log against in-process journey finders
+
+Usage (from the notebooks directory):
+
+    python replay.py queries.jsonl --concurrency 4 --rate 20
+    python replay.py queries.jsonl --compare ../old/journey_finder.py
+
+The log is written by `query_log.QueryRecorder`. With `--compare` the log is
+also replayed against the `JourneyFinder` of another journey_finder.py and
+queries with different journeys are reported. The other version only needs
+`find` and `best_journeys`, older versions without a station registry work too.
+"""
+import argparse
+import collections
+import importlib.util
+import inspect
+import itertools
+import queue
+import threading
+import time
+
+import numpy as np
+
+import data
+from journey_finder import JourneyFinder
+from query_log import read_queries
+from station_registry import StationRegistry
+
+
+Result = collections.namedtuple('Result', 'query latency journeys error')
+
+
+def replay(make_finder, queries, concurrency=1, rate=None):
+    """Runs all queries and returns a list of `Result`s and the elapsed time
+
+    `concurrency` threads each run queries on their own finder, which is
+    created by calling `make_finder`. The finders are created before the
+    clock starts, so building them is not part of the elapsed time or the
+    latencies.
+    If `rate` (queries per second) is given, query `i` is started at
+    `i / rate` seconds after the start and its latency includes the time
+    it waited for a free thread.
+    """
+    results = [None] * len(queries)
+    pending = queue.Queue()
+    for item in enumerate(queries):
+        pending.put(item)
+
+    finders = [make_finder() for _ in range(concurrency)]
+
+    def worker(finder):
+        while True:
+            try:
+                i, query = pending.get_nowait()
+            except queue.Empty:
+                return
+            if rate:
+                scheduled = start + i / rate
+                time.sleep(max(0.0, scheduled - time.perf_counter()))
+            else:
+                scheduled = time.perf_counter()
+            try:
+                finder.find(query.departure, query.arrival, query.arrival_time,
+                            min_probability=query.min_probability, transfer_time=query.transfer_time)
+                journeys, error = finder.best_journeys(), None
+            except Exception as e:
+                journeys, error = None, e
+            results[i] = Result(query, time.perf_counter() - scheduled, journeys, error)
+
+    threads = [threading.Thread(target=worker, args=(finder,)) for finder in finders]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def repeated_query_rate(queries):
+    """Returns the fraction of queries that repeat an earlier query
+
+    The finder has no result cache, this is an upper bound for the hit rate
+    of a result cache keyed on the query.
+    """
+    if not queries:
+        return 0.0
+    return 1 - len(set(queries)) / len(queries)
+
+
+def latency_histogram(latencies, width=40):
+    """Formats latencies (in seconds) as a text histogram with logarithmic buckets"""
+    latencies = np.asarray(latencies) * 1000
+    lines = [
+        f'p50 {np.percentile(latencies, 50):.1f} ms, p90 {np.percentile(latencies, 90):.1f} ms, '
+        f'p99 {np.percentile(latencies, 99):.1f} ms, max {latencies.max():.1f} ms'
+    ]
+    low = np.floor(np.log2(max(latencies.min(), 1e-3)))
+    high = max(np.ceil(np.log2(max(latencies.max(), 1e-3))), low + 1)
+    counts, edges = np.histogram(latencies, bins=2.0 ** np.arange(low, high + 1))
+    for count, left, right in zip(counts, edges, edges[1:]):
+        bar = '#' * int(round(width * count / counts.max()))
+        lines.append(f'{left:>9.3f} - {right:>9.3f} ms | {bar} {count}')
+    return '\n'.join(lines)
+
+
+def journey_signature(journeys):
+    """Returns a comparable representation of a `best_journeys` dataframe
+
+    Footpath trip ids are generated per query and therefore ignored.
+    """
+    if journeys is None:
+        return None
+    return [
+        (row.path, row.start_id, row.start_time, row.stop_id, row.stop_time,
+         'foot' if row.transport_type == 'foot' else row.trip_id, round(row.probability, 9))
+        for row in journeys.itertuples()
+    ]
+
+
+def diff_results(results, other_results):
+    """Returns the indices of queries for which the journeys differ"""
+    return [
+        i for i, (result, other) in enumerate(zip(results, other_results))
+        if journey_signature(result.journeys) != journey_signature(other.journeys)
+    ]
+
+
+def report(name, results, elapsed):
+    errors = [result for result in results if result.error is not None]
+    print(f'== {name}')
+    print(f'{len(results)} queries in {elapsed:.2f} s ({len(results) / elapsed:.1f} queries/s), {len(errors)} errors')
+    if len(errors) < len(results):
+        print(latency_histogram([result.latency for result in results if result.error is None]))
+    for result in errors[:5]:
+        print(f'error: {result.query} {result.error!r}')
+
+
+def build_finder(finder_class, connections, footpaths, registry):
+    """Creates a finder, `registry` is only passed if the constructor accepts it"""
+    if 'registry' in inspect.signature(finder_class).parameters:
+        return finder_class(connections, footpaths, registry)
+    return finder_class(connections, footpaths)
+
+
+def finder_factory(finder_class, connections, footpaths, registry):
+    """Returns a function that creates a finder for every replay thread
+
+    Finders with a `copy` method share their connections between threads,
+    otherwise a new finder is built for every thread.
+    """
+    finder = build_finder(finder_class, connections, footpaths, registry)
+    if hasattr(finder, 'copy'):
+        return finder.copy
+    finders = [finder]
+    return lambda: finders.pop() if finders else build_finder(finder_class, connections, footpaths, registry)
+
+
+def load_finder_class(path):
+    """Loads `JourneyFinder` from a journey_finder.py of another version"""
+    spec = importlib.util.spec_from_file_location('other_journey_finder', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.JourneyFinder
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a JSONL query log against the journey finder')
+    parser.add_argument('log', help='query log written by query_log.QueryRecorder')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of concurrent queries')
+    parser.add_argument('--rate', type=float, default=None, help='queries per second, unlimited by default')
+    parser.add_argument('--compare', default=None, help='journey_finder.py of another version to diff results against')
+    args = parser.parse_args()
+
+    queries = read_queries(args.log)
+    connections, footpaths, stations = data.load_data()
+    registry = StationRegistry(stations, itertools.chain(connections['start_id'], connections['stop_id']))
+    print(f'repeated queries (upper bound for a result cache): {repeated_query_rate(queries):.1%}')
+
+    engines = [('current', JourneyFinder)]
+    if args.compare:
+        engines.append((args.compare, load_finder_class(args.compare)))
+
+    all_results = []
+    for name, finder_class in engines:
+        make_finder = finder_factory(finder_class, connections, footpaths, registry)
+        results, elapsed = replay(make_finder, queries, concurrency=args.concurrency, rate=args.rate)
+        report(name, results, elapsed)
+        all_results.append(results)
+
+    if args.compare:
+        different = diff_results(*all_results)
+        print(f'== diff: {len(different)} of {len(queries)} queries have different journeys')
+        for i in different[:10]:
+            print(f'line {i + 1}: {queries[i]}')
+
+
+if __name__ == '__main__':
+    main()
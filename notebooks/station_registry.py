@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def normalize_id(station_id):
+    """Converts an external station id (GTFS string or StationID) to an int"""
+    return int(station_id)
+
+
+class StationRegistry:
+    """Maps external station ids to dense int32 indices
+
+    Coordinates and names are stored in contiguous arrays that are indexed
+    by the dense station index. A single registry is shared by the journey
+    finder, planner and visualization so that station lookups never go
+    through a DataFrame.
+    """
+
+    def __init__(self, stations, extra_ids=()):
+        ids = [normalize_id(station_id) for station_id in stations['station_id']]
+        lat = list(stations['lat'])
+        lon = list(stations['lon'])
+        names = list(stations['station_name'])
+
+        self._index = {station_id: index for index, station_id in enumerate(ids)}
+
+        # stations that appear in connections/footpaths but have no entry in
+        # the stations table get an index without coordinates
+        for station_id in extra_ids:
+            station_id = normalize_id(station_id)
+            if station_id not in self._index:
+                self._index[station_id] = len(ids)
+                ids.append(station_id)
+                lat.append(np.nan)
+                lon.append(np.nan)
+                names.append(str(station_id))
+
+        self.ids = np.array(ids, dtype=np.int64)
+        self.lat = np.array(lat, dtype=np.float64)
+        self.lon = np.array(lon, dtype=np.float64)
+        self.names = np.array(names, dtype=object)
+        self._name_index = {name: index for index, name in reversed(list(enumerate(names)))}
+
+        # sorted ids are used for vectorized lookups in `indices`
+        self._order = np.argsort(self.ids).astype(np.int32)
+        self._sorted_ids = self.ids[self._order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, station_id):
+        return normalize_id(station_id) in self._index
+
+    def index(self, station_id):
+        """Returns the dense index of an external station id"""
+        return self._index[normalize_id(station_id)]
+
+    def indices(self, station_ids):
+        """Returns the dense indices of an array of external station ids"""
+        station_ids = np.asarray(station_ids).astype(np.int64)
+        positions = np.searchsorted(self._sorted_ids, station_ids)
+        positions = np.clip(positions, 0, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == station_ids
+        if not np.all(found):
+            raise KeyError(station_ids[~found][0])
+        return self._order[positions]
+
+    def index_from_name(self, name):
+        """Returns the dense index of the first station called `name`"""
+        return self._name_index[name]
+
+    def closest(self, lat, lon):
+        """Returns the dense index of the station closest to (`lat`, `lon`)"""
+        distances = (self.lat - lat) ** 2 + (self.lon - lon) ** 2
+        return int(np.nanargmin(distances))